@@ -1,7 +1,9 @@
 import sys
+from collections import OrderedDict
+
 import numpy as np
 from PIL import Image
-from PySide6.QtCore import Qt
+from PySide6.QtCore import QCoreApplication, QEvent, QObject, QRunnable, Qt, QThreadPool, QTimer, Signal
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QGridLayout, QLabel, QPushButton, QComboBox, QSlider, QCheckBox,
@@ -9,9 +11,53 @@ from PySide6.QtWidgets import (
 )
 from PySide6.QtGui import QImage, QPixmap, QIcon
 
-from normalizer_logic import NormalizerLogic
+from normalizer_logic import NormalizerLogic, save_png16
+
+try:
+    import numba
+except ImportError:
+    pass
+else:
+    # Kernels are launched from a worker thread; TBB initialised that way can hang
+    # interpreter shutdown, so prefer OpenMP when it is available. Set on import so it
+    # applies however the window is created, before any kernel has run.
+    numba.config.THREADING_LAYER_PRIORITY = ["omp", "tbb", "workqueue"]
+
+class _WorkerSignals(QObject):
+    finished = Signal(int, object, object) # job id, cache key (None for previews), normal map
+    failed = Signal(int, object, str)
+
+class NormalizerWorker(QRunnable):
+    """Runs one generate_normal_map call off the GUI thread.
+
+    Previews carry no cache key: they are shown but never cached or saved.
+    """
+
+    def __init__(self, job_id, cache_key, logic, image_data, params):
+        super().__init__()
+        self.job_id = job_id
+        self.cache_key = cache_key
+        self.logic = logic
+        self.image_data = image_data
+        self.params = params
+        self.signals = _WorkerSignals()
+        self.started = False
+
+    def run(self):
+        self.started = True
+        try:
+            result = self.logic.generate_normal_map(self.image_data, self.params)
+        except Exception as e:
+            self.signals.failed.emit(self.job_id, self.cache_key, str(e))
+            return
+        self.signals.finished.emit(self.job_id, self.cache_key, result)
 
 class MainWindow(QMainWindow):
+    RESULT_CACHE_SIZE = 8
+    RECOMPUTE_DELAY_MS = 80
+    REFINE_DELAY_MS = 500
+    PREVIEW_MAX_SIZE = 1024
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Normal Map Generator v1.3")
@@ -23,7 +69,37 @@ class MainWindow(QMainWindow):
 
         self.original_image_data = None
         self.processed_image_data = None
+        self._preview_buffer = None
         self.logic = NormalizerLogic()
+        # Previews get their own instance so full-size and preview scratch buffers both stay allocated.
+        self.preview_logic = NormalizerLogic()
+        self._processed_key = None
+        self._pending_refine = None
+        # Recent results keyed on (input version, params) so re-emitted or toggled-back settings are instant.
+        self._cache = OrderedDict()
+        self._input_version = 0
+
+        # A single worker thread runs every pipeline call, previews included: Numba's
+        # workqueue threading layer aborts on concurrent parallel launches, and queued
+        # jobs are dropped whenever a newer one supersedes them.
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(1)
+        self._job_id = 0
+        self._workers = {}
+        # Get JIT compilation out of the way before the first image arrives.
+        self._pool.start(self.logic.warm_up)
+
+        # Coalesces bursts of slider/checkbox changes into a single recompute.
+        self._recompute_timer = QTimer(self)
+        self._recompute_timer.setSingleShot(True)
+        self._recompute_timer.setInterval(self.RECOMPUTE_DELAY_MS)
+        self._recompute_timer.timeout.connect(self._process_image)
+
+        # Full-resolution work starts only once the settings have been idle for a while.
+        self._refine_timer = QTimer(self)
+        self._refine_timer.setSingleShot(True)
+        self._refine_timer.setInterval(self.REFINE_DELAY_MS)
+        self._refine_timer.timeout.connect(self._start_refine)
 
         main_widget = QWidget()
         main_layout = QHBoxLayout(main_widget)
@@ -47,6 +123,12 @@ class MainWindow(QMainWindow):
         gen_group = self._create_generator_controls()
         export_group = self._create_export_controls()
 
+        # Controls that only make sense once an image is loaded.
+        self._disableable = [
+            self.save_button, self.hq_mode_check, self.smoothness_slider, self.intensity_slider,
+            self.invert_x_check, self.invert_y_check, self.bit_depth_combo
+        ]
+
         controls_layout.addWidget(self.load_button)
         controls_layout.addWidget(self.save_button)
         controls_layout.addWidget(gen_group)
@@ -66,7 +148,7 @@ class MainWindow(QMainWindow):
         layout.setColumnStretch(1, 1)
 
         self.hq_mode_check = QCheckBox("High-Quality Mode (Slower)")
-        self.hq_mode_check.stateChanged.connect(self._process_image)
+        self.hq_mode_check.stateChanged.connect(self._schedule_process)
 
         # --- Smoothness Slider ---
         self.smoothness_slider = QSlider(Qt.Orientation.Horizontal)
@@ -83,10 +165,10 @@ class MainWindow(QMainWindow):
         self.intensity_slider.valueChanged.connect(self._on_slider_change)
         
         self.invert_x_check = QCheckBox("Invert X (Red)")
-        self.invert_x_check.stateChanged.connect(self._process_image)
+        self.invert_x_check.stateChanged.connect(self._schedule_process)
         
         self.invert_y_check = QCheckBox("Invert Y (Green)")
-        self.invert_y_check.stateChanged.connect(self._process_image)
+        self.invert_y_check.stateChanged.connect(self._schedule_process)
 
         layout.addWidget(self.hq_mode_check, 0, 0, 1, 3)
         layout.addWidget(QLabel("Smoothness:"), 1, 0)
@@ -106,7 +188,11 @@ class MainWindow(QMainWindow):
         intensity_val = self.intensity_slider.value() / 10.0
         self.intensity_label.setText(f"{intensity_val:.1f}")
 
-        self._process_image()
+        self._schedule_process()
+
+    def _schedule_process(self):
+        # Restarting the single-shot timer pushes the recompute back until input settles.
+        self._recompute_timer.start()
 
     def _create_export_controls(self):
         group = QGroupBox("Export Settings")
@@ -131,68 +217,173 @@ class MainWindow(QMainWindow):
                 with Image.open(file_path) as img:
                     img_rgb = img.convert("RGB")
                     self.original_image_data = np.array(img_rgb)
-                self._on_slider_change() # Initial process
+                self._input_version += 1
+                self._cache.clear()
+                self.processed_image_data = None
+                self._processed_key = None
+                self._process_image() # Initial process
             except Exception as e:
                 QMessageBox.critical(self, "Error", f"Failed to load image:\n{e}")
                 self.original_image_data = None
             self._update_ui_state()
 
     def _save_image(self):
-        if self.processed_image_data is None:
+        if self.original_image_data is None:
             return
 
         file_path, _ = QFileDialog.getSaveFileName(self, "Save Image", "", "PNG (*.png);;JPEG (*.jpg);;BMP (*.bmp)")
         if file_path:
             try:
+                self._finish_full_resolution()
                 img_to_save = self.processed_image_data
                 
                 if "16-bit" in self.bit_depth_combo.currentText() and file_path.lower().endswith('.png'):
-                    img_to_save_16bit = (img_to_save.astype(np.uint16) * 257)
-                    r = Image.fromarray(img_to_save_16bit[:,:,0], mode='I;16')
-                    g = Image.fromarray(img_to_save_16bit[:,:,1], mode='I;16')
-                    b = Image.fromarray(img_to_save_16bit[:,:,2], mode='I;16')
-                    final_img = Image.merge("RGB", (r, g, b))
+                    save_png16(file_path, img_to_save)
                 else:
-                    final_img = Image.fromarray(img_to_save)
-                
-                final_img.save(file_path)
+                    Image.fromarray(img_to_save).save(file_path)
 
             except Exception as e:
                 QMessageBox.critical(self, "Error", f"Failed to save image:\n{e}")
 
-    def _process_image(self):
-        if self.original_image_data is None:
-            return
-
-        params = {
+    def _current_params(self):
+        return {
             'high_quality': self.hq_mode_check.isChecked(),
             'smoothness': self.smoothness_slider.value() / 10.0,
             'intensity': self.intensity_slider.value() / 10.0,
             'invert_x': self.invert_x_check.isChecked(),
             'invert_y': self.invert_y_check.isChecked()
         }
-        self.processed_image_data = self.logic.generate_normal_map(self.original_image_data, params)
+
+    def _cache_key(self, params):
+        return (self._input_version, tuple(sorted(params.items())))
+
+    def _preview_scale(self):
+        return max(1, max(self.original_image_data.shape[:2]) // self.PREVIEW_MAX_SIZE)
+
+    def _process_image(self):
+        if self.original_image_data is None:
+            return
+
+        params = self._current_params()
+        key = self._cache_key(params)
+
+        # Any result still in flight is now stale.
+        self._job_id += 1
+        self._cancel_queued_jobs()
+        self._refine_timer.stop()
+
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            self.processed_image_data = self._cache[key]
+            self._processed_key = key
+            self._update_displays()
+            return
+
+        scale = self._preview_scale()
+        if scale == 1:
+            self._start_full_resolution(key, params)
+            return
+
+        # Interactive feedback from a decimated copy, queued ahead of the full-size refine.
+        # pixel_scale makes the logic rescale its pixel-unit quantities to match the final map.
+        preview_params = dict(params, pixel_scale=scale)
+        self._start_job(None, self.preview_logic, self.original_image_data[::scale, ::scale], preview_params)
+
+        self._pending_refine = (key, params)
+        self._refine_timer.start()
+
+    def _cancel_queued_jobs(self):
+        self._pool.clear()
+        # Cleared workers never emit, so only a job that already started will report back.
+        self._workers = {job: worker for job, worker in self._workers.items() if worker.started}
+
+    def _start_refine(self):
+        if self._pending_refine is not None:
+            self._start_full_resolution(*self._pending_refine)
+            self._pending_refine = None
+
+    def _start_full_resolution(self, key, params):
+        self._start_job(key, self.logic, self.original_image_data, params)
+
+    def _start_job(self, key, logic, image_data, params):
+        worker = NormalizerWorker(self._job_id, key, logic, image_data, params)
+        worker.signals.finished.connect(self._apply_result)
+        worker.signals.failed.connect(self._on_worker_failed)
+        # A job id can have both a preview and a full-size worker.
+        self._workers[(self._job_id, key is None)] = worker
+        self._pool.start(worker)
+
+    def _finish_full_resolution(self):
+        """Make processed_image_data match the current settings, computing it here if needed."""
+        self._refine_timer.stop()
+        self._pending_refine = None
+        self._pool.waitForDone()
+        # Deliver results the worker has already queued so a finished job isn't redone here.
+        QCoreApplication.sendPostedEvents(self, QEvent.Type.MetaCall)
+
+        params = self._current_params()
+        key = self._cache_key(params)
+        if key == self._processed_key:
+            return
+
+        if key not in self._cache:
+            self._store_result(key, self.logic.generate_normal_map(self.original_image_data, params))
+        self.processed_image_data = self._cache[key]
+        self._processed_key = key
+        self._update_displays()
+
+    def _store_result(self, key, result):
+        self._cache[key] = result
+        if len(self._cache) > self.RESULT_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def _apply_result(self, job_id, key, result):
+        self._workers.pop((job_id, key is None), None)
+        if key is None:
+            if job_id == self._job_id:
+                self.processed_image_label.setPixmap(self._numpy_to_pixmap(result))
+            return
+
+        self._store_result(key, result)
+        if job_id != self._job_id:
+            return
+        self.processed_image_data = result
+        self._processed_key = key
         self._update_displays()
 
+    def _on_worker_failed(self, job_id, key, message):
+        self._workers.pop((job_id, key is None), None)
+        if job_id == self._job_id:
+            QMessageBox.critical(self, "Error", f"Failed to process image:\n{message}")
+
+    def closeEvent(self, event):
+        self._pool.clear()
+        self._pool.waitForDone()
+        super().closeEvent(event)
+
     def _update_displays(self):
         if self.processed_image_data is not None:
             self.processed_image_label.setPixmap(self._numpy_to_pixmap(self.processed_image_data))
 
     def _numpy_to_pixmap(self, array):
-        h, w, ch = array.shape
+        label_size = self.processed_image_label.size()
+        # Decimate in numpy first so Qt only ever sees roughly label-sized data.
+        stride = max(1, min(array.shape[1] // max(1, label_size.width()), array.shape[0] // max(1, label_size.height())))
+        # QImage does not own the buffer, so keep it alive on self.
+        self._preview_buffer = np.ascontiguousarray(array[::stride, ::stride])
+        h, w, ch = self._preview_buffer.shape
         bytes_per_line = ch * w
-        q_image = QImage(array.data, w, h, bytes_per_line, QImage.Format.Format_RGB888)
+        q_image = QImage(self._preview_buffer.data, w, h, bytes_per_line, QImage.Format.Format_RGB888)
         pixmap = QPixmap.fromImage(q_image)
-        return pixmap.scaled(self.processed_image_label.size(), Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+        return pixmap.scaled(label_size, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
 
     def _update_ui_state(self):
         is_loaded = self.original_image_data is not None
-        for child in self.findChildren(QWidget):
-            if isinstance(child, (QComboBox, QSlider, QCheckBox, QPushButton)) and child != self.load_button:
-                child.setEnabled(is_loaded)
+        for widget in self._disableable:
+            widget.setEnabled(is_loaded)
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
-    sys.exit(app.exec())
\ No newline at end of file
+    sys.exit(app.exec())
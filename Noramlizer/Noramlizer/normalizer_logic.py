@@ -1,12 +1,187 @@
 from __future__ import annotations
 
+import os
+import struct
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Optional
+from typing import Callable, Optional
 
 import numpy as np
-from scipy.ndimage import convolve, gaussian_filter
+from scipy import fft
+from scipy.ndimage import correlate1d, gaussian_filter
 from skimage.restoration import denoise_bilateral
 
+try:
+    import numba
+except ImportError:  # numba is optional; the numpy code paths are used without it.
+    numba = None
+
+if numba is not None:
+
+    @numba.njit(inline="always", cache=True)
+    def _unit_to_byte(value):
+        # Clamp before converting: fastmath may overshoot +-1 slightly, and an
+        # out-of-range float-to-uint8 conversion would wrap around.
+        scaled = value * 127.5 + 127.5
+        if scaled <= 0.0:
+            return np.uint8(0)
+        if scaled >= 255.0:
+            return np.uint8(255)
+        return np.uint8(scaled + 0.5)
+
+    @numba.njit(inline="always", cache=True)
+    def _pack_normal(out, i, j, nx, ny):
+        inv_m = 1.0 / np.sqrt(nx * nx + ny * ny + 1.0)
+        out[i, j, 0] = _unit_to_byte(nx * inv_m)
+        out[i, j, 1] = _unit_to_byte(ny * inv_m)
+        out[i, j, 2] = _unit_to_byte(inv_m)
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _scharr_encode(height_map, scale_x, scale_y, out):
+        """Scharr gradients and normal encoding fused: height map in, RGB8 out, no temporaries."""
+        height, width = height_map.shape
+        for i in numba.prange(height):
+            # For a one-pixel reach, clamping is the same as scipy.ndimage's "reflect" mode.
+            up = max(i - 1, 0)
+            down = min(i + 1, height - 1)
+            for j in range(width):
+                left = max(j - 1, 0)
+                right = min(j + 1, width - 1)
+                grad_x = (
+                    3.0 * (height_map[up, right] - height_map[up, left])
+                    + 10.0 * (height_map[i, right] - height_map[i, left])
+                    + 3.0 * (height_map[down, right] - height_map[down, left])
+                ) / 32.0
+                grad_y = (
+                    3.0 * (height_map[down, left] - height_map[up, left])
+                    + 10.0 * (height_map[down, j] - height_map[up, j])
+                    + 3.0 * (height_map[down, right] - height_map[up, right])
+                ) / 32.0
+                _pack_normal(out, i, j, grad_x * scale_x, grad_y * scale_y)
+
+    @numba.njit(inline="always", cache=True)
+    def _reflect_index(index, size):
+        # Matches scipy.ndimage's "reflect" mode (d c b a | a b c d | d c b a).
+        while index < 0 or index >= size:
+            if index < 0:
+                index = -index - 1
+            else:
+                index = 2 * size - index - 1
+        return index
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _bilateral_window(height_map, spatial_lut, color_lut):
+        """Brute-force bilateral filter over a square (2r+1)^2 window."""
+        height, width = height_map.shape
+        radius = (spatial_lut.size - 1) // 2
+        lut_max = color_lut.size - 1
+        out = np.empty_like(height_map)
+        for i in numba.prange(height):
+            for j in range(width):
+                center = height_map[i, j]
+                acc = 0.0
+                norm = 0.0
+                for di in range(-radius, radius + 1):
+                    row = _reflect_index(i + di, height)
+                    weight_y = spatial_lut[di + radius]
+                    for dj in range(-radius, radius + 1):
+                        value = height_map[row, _reflect_index(j + dj, width)]
+                        bin_index = min(int(abs(value - center) * lut_max + 0.5), lut_max)
+                        weight = weight_y * spatial_lut[dj + radius] * color_lut[bin_index]
+                        acc += weight * value
+                        norm += weight
+                out[i, j] = acc / norm
+        return out
+
+    @numba.njit(fastmath=True, cache=True)
+    def _recursive_bilateral_line(values, guide, out, alpha, color_lut):
+        # One causal and one anti-causal first-order recursion, each with the
+        # feedback weight scaled by the range kernel of neighbouring guide pixels.
+        # Both passes include the centre sample with weight (1 - alpha); it is
+        # subtracted once when they are combined so it isn't counted twice.
+        size = values.size
+        lut_max = color_lut.size - 1
+        centre = 1.0 - alpha
+        causal = np.empty(size, dtype=np.float32)
+        causal_norm = np.empty(size, dtype=np.float32)
+        causal[0] = values[0]
+        causal_norm[0] = 1.0
+        for k in range(1, size):
+            bin_index = min(int(abs(guide[k] - guide[k - 1]) * lut_max + 0.5), lut_max)
+            feedback = alpha * color_lut[bin_index]
+            causal[k] = centre * values[k] + feedback * causal[k - 1]
+            causal_norm[k] = centre + feedback * causal_norm[k - 1]
+
+        acc = values[size - 1]
+        norm = 1.0
+        out[size - 1] = (causal[size - 1] + acc - centre * values[size - 1]) / (causal_norm[size - 1] + norm - centre)
+        for k in range(size - 2, -1, -1):
+            bin_index = min(int(abs(guide[k] - guide[k + 1]) * lut_max + 0.5), lut_max)
+            feedback = alpha * color_lut[bin_index]
+            acc = centre * values[k] + feedback * acc
+            norm = centre + feedback * norm
+            out[k] = (causal[k] + acc - centre * values[k]) / (causal_norm[k] + norm - centre)
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _bilateral_recursive(height_map, alpha, color_lut):
+        """Recursive bilateral filter (Yang, 2012): O(1) work per pixel for any sigma."""
+        height, width = height_map.shape
+        horizontal = np.empty_like(height_map)
+        for i in numba.prange(height):
+            _recursive_bilateral_line(height_map[i], height_map[i], horizontal[i], alpha, color_lut)
+
+        out = np.empty_like(height_map)
+        for j in numba.prange(width):
+            column = np.ascontiguousarray(horizontal[:, j])
+            result = np.empty(height, dtype=np.float32)
+            _recursive_bilateral_line(column, np.ascontiguousarray(height_map[:, j]), result, alpha, color_lut)
+            out[:, j] = result
+        return out
+
+else:
+    _scharr_encode = None
+    _bilateral_window = None
+    _bilateral_recursive = None
+
+
+_REC709_LUMA = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+
+
+def _srgb_to_linear(values: np.ndarray) -> np.ndarray:
+    srgb_threshold = 0.04045
+    return np.where(
+        values <= srgb_threshold,
+        values / np.float32(12.92),
+        ((values + np.float32(0.055)) / np.float32(1.055)) ** np.float32(2.4),
+    ).astype(np.float32, copy=False)
+
+
+def save_png16(file_path: str, image: np.ndarray) -> None:
+    """Write an (H, W, 3) uint8 image as a 16-bit-per-channel RGB PNG.
+
+    Pillow cannot write 48-bit RGB, so the file is encoded directly. Each value is
+    widened as x * 257, whose high and low bytes are both x, so every big-endian
+    sample is just the 8-bit value written twice and no uint16 array is built.
+    """
+    height, width, _ = image.shape
+    # Each scanline is a filter-type byte (0 = none) followed by the samples.
+    scanlines = np.zeros((height, 1 + width * 6), dtype=np.uint8)
+    samples = image.reshape(height, width * 3)
+    scanlines[:, 1::2] = samples
+    scanlines[:, 2::2] = samples
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 16, 2, 0, 0, 0)
+    with open(file_path, "wb") as fh:
+        fh.write(b"\x89PNG\r\n\x1a\n")
+        fh.write(chunk(b"IHDR", header))
+        fh.write(chunk(b"IDAT", zlib.compress(scanlines.tobytes())))
+        fh.write(chunk(b"IEND", b""))
+
 
 @dataclass(frozen=True)
 class NormalMapParams:
@@ -16,13 +191,45 @@ class NormalMapParams:
     invert_x: bool = False
     invert_y: bool = False
     linearize_srgb: bool = True
+    # Full-resolution pixels per input pixel, for previews of decimated images. Spatial
+    # quantities (smoothing radius, slope per pixel) are rescaled by it so the result
+    # matches the full-size map.
+    pixel_scale: float = 1.0
 
 
 class NormalizerLogic:
     """Image-processing pipeline for generating tangent-space normal maps."""
 
-    _SCHARR_X = np.array([[-3.0, 0.0, 3.0], [-10.0, 0.0, 10.0], [-3.0, 0.0, 3.0]], dtype=np.float32) / 32.0
-    _SCHARR_Y = np.array([[-3.0, -10.0, -3.0], [0.0, 0.0, 0.0], [3.0, 10.0, 3.0]], dtype=np.float32) / 32.0
+    # Above this spatial sigma the windowed bilateral filter gets too wide; use the recursive one.
+    _RECURSIVE_BILATERAL_SIGMA = 5.0
+    # The two filters weigh edges differently (centre vs. neighbour differences), so
+    # up to this sigma the recursive result is cross-faded with the windowed one at
+    # _RECURSIVE_BILATERAL_SIGMA to keep the output continuous across the switch.
+    _RECURSIVE_BILATERAL_BLEND_END = 7.5
+    _BILATERAL_COLOR_BINS = 256
+    # From this sigma on, Gaussian smoothing is done in the frequency domain.
+    _FFT_GAUSSIAN_SIGMA = 3.0
+    # Only the two 1D kernel spectra are cached, so entries are small.
+    _KERNEL_FFT_CACHE_SIZE = 16
+    # Images shorter than this are filtered on the calling thread; banding them isn't worth it.
+    _PARALLEL_MIN_ROWS = 512
+
+    # Row k maps an 8-bit sRGB value to its weighted contribution to linear luminance.
+    _LINEAR_LUMA_LUT = _REC709_LUMA[:, None] * _srgb_to_linear(np.arange(256, dtype=np.float32) / np.float32(255.0))
+
+    # Scharr is separable: [3, 10, 3]^T (smoothing) x [-1, 0, 1] (derivative), / 32.
+    _SCHARR_SMOOTH = np.array([3.0, 10.0, 3.0], dtype=np.float32) / 16.0
+    _SCHARR_DIFF = np.array([-1.0, 0.0, 1.0], dtype=np.float32) / 2.0
+
+    def __init__(self) -> None:
+        self._kernel_fft_cache: OrderedDict[tuple, tuple[np.ndarray, np.ndarray]] = OrderedDict()
+        # Per-call intermediates, reused across calls while the image shape stays the same.
+        self._scratch: dict[str, np.ndarray] = {}
+        self._workers = os.cpu_count() or 1
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Compiled entry points of the fused kernel per input dtype; calling them skips
+        # Numba's per-call type dispatch.
+        self._jit_cache: dict[np.dtype, Callable] = {}
 
     def generate_normal_map(self, image_data: np.ndarray, params: dict | NormalMapParams) -> Optional[np.ndarray]:
         if image_data is None:
@@ -33,74 +240,300 @@ class NormalizerLogic:
         height_map = self._to_height_map(image_data, linearize=config.linearize_srgb)
         height_map = self._apply_smoothing(height_map, config)
 
-        grad_x = convolve(height_map, self._SCHARR_X, mode="reflect")
-        grad_y = convolve(height_map, self._SCHARR_Y, mode="reflect")
+        if _scharr_encode is not None:
+            return self._scharr_encode_fused(height_map, config)
 
-        return self._encode_normal_map(grad_x, grad_y, config.intensity, config.invert_x, config.invert_y)
+        grad_x, grad_y = self._scharr_gradients(height_map)
 
-    @staticmethod
-    def _to_height_map(image_data: np.ndarray, linearize: bool) -> np.ndarray:
-        img_float = image_data.astype(np.float32) / 255.0
-
-        if linearize:
-            srgb_threshold = 0.04045
-            img_linear = np.where(
-                img_float <= srgb_threshold,
-                img_float / 12.92,
-                ((img_float + 0.055) / 1.055) ** 2.4,
-            )
-        else:
-            img_linear = img_float
+        scale_x, scale_y = self._axis_scales(config.intensity / config.pixel_scale, config.invert_x, config.invert_y)
+        return self._encode_normal_map(grad_x, grad_y, scale_x, scale_y)
 
-        # Rec. 709 luminance.
-        return (
-            img_linear[:, :, 0] * 0.2126
-            + img_linear[:, :, 1] * 0.7152
-            + img_linear[:, :, 2] * 0.0722
+    def warm_up(self) -> None:
+        """Compile the Numba kernels now so the first real image doesn't wait on the JIT."""
+        if numba is None:
+            return
+
+        image = np.zeros((8, 8, 3), dtype=np.uint8)
+        self.generate_normal_map(image, NormalMapParams())
+        self.generate_normal_map(image, NormalMapParams(high_quality=True, smoothness=1.0))
+        self.generate_normal_map(
+            image, NormalMapParams(high_quality=True, smoothness=self._RECURSIVE_BILATERAL_SIGMA + 1.0)
         )
 
-    @staticmethod
-    def _apply_smoothing(height_map: np.ndarray, params: NormalMapParams) -> np.ndarray:
+    def _scharr_encode_fused(self, height_map: np.ndarray, config: NormalMapParams) -> np.ndarray:
+        height_map = np.ascontiguousarray(height_map)
+        kernel = self._jit_cache.get(height_map.dtype)
+        if kernel is None:
+            # Numba specializations depend on dtype and layout, not on the image size.
+            value_type = numba.from_dtype(height_map.dtype)
+            kernel = _scharr_encode.compile((value_type[:, ::1], value_type, value_type, numba.uint8[:, :, ::1]))
+            self._jit_cache[height_map.dtype] = kernel
+
+        scale_x, scale_y = self._axis_scales(config.intensity / config.pixel_scale, config.invert_x, config.invert_y)
+        normal_map = np.empty(height_map.shape + (3,), dtype=np.uint8)
+        kernel(height_map, height_map.dtype.type(scale_x), height_map.dtype.type(scale_y), normal_map)
+        return normal_map
+
+    def _buf(self, name: str, shape: tuple[int, ...], dtype=np.float32) -> np.ndarray:
+        """Return the scratch array ``name``, reallocating it only if shape or dtype changed.
+
+        Scratch contents are only valid until the next call into the pipeline, so they
+        must never be returned to callers.
+        """
+        buf = self._scratch.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self._scratch[name] = buf
+        return buf
+
+    def _parallel_filter(
+        self,
+        arr: np.ndarray,
+        fn: Callable[[np.ndarray], np.ndarray],
+        halo: int,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """Apply ``fn`` to overlapping row bands of ``arr`` concurrently and stitch the results.
+
+        ``halo`` must cover the filter's reach along axis 0. Bands at the top and bottom
+        start at the real image edge, so ``fn``'s boundary mode still applies there.
+        scipy.ndimage releases the GIL in its filter loops, so the bands run in parallel.
+        """
+        rows = arr.shape[0]
+        workers = min(self._workers, rows // max(1, 2 * halo + 1))
+        if workers <= 1 or rows < self._PARALLEL_MIN_ROWS:
+            if out is None:
+                return fn(arr)
+            out[...] = fn(arr)
+            return out
+
+        if out is None:
+            out = np.empty_like(arr)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="normalizer")
+
+        bounds = np.linspace(0, rows, workers + 1).astype(int)
+
+        def run_band(index: int) -> None:
+            start, stop = bounds[index], bounds[index + 1]
+            lo, hi = max(0, start - halo), min(rows, stop + halo)
+            out[start:stop] = fn(arr[lo:hi])[start - lo : stop - lo]
+
+        # list() re-raises any exception from a band.
+        list(self._executor.map(run_band, range(workers)))
+        return out
+
+    def _to_height_map(self, image_data: np.ndarray, linearize: bool) -> np.ndarray:
+        if image_data.dtype == np.uint8:
+            if linearize:
+                # Per-channel LUTs already hold the weighted linear value, so the
+                # decode and the luminance weights cost three lookups per pixel.
+                lut = self._LINEAR_LUMA_LUT
+                shape = image_data.shape[:2]
+                height_map = np.take(lut[0], image_data[:, :, 0], out=self._buf("height_map", shape))
+                channel = self._buf("luma_channel", shape)
+                height_map += np.take(lut[1], image_data[:, :, 1], out=channel)
+                height_map += np.take(lut[2], image_data[:, :, 2], out=channel)
+                return height_map
+
+            # Rec. 709 weights in 8-bit fixed point: (54, 183, 19) / 256.
+            r = image_data[:, :, 0].astype(np.uint16)
+            g = image_data[:, :, 1].astype(np.uint16)
+            b = image_data[:, :, 2].astype(np.uint16)
+            luma8 = ((54 * r + 183 * g + 19 * b + 128) >> 8).astype(np.uint8)
+            return luma8.astype(np.float32) * np.float32(1.0 / 255.0)
+
+        img_float = image_data.astype(np.float32) * np.float32(1.0 / 255.0)
+        img_linear = _srgb_to_linear(img_float) if linearize else img_float
+
+        # Rec. 709 luminance as a (H, W, 3) x (3,) product, which numpy hands to BLAS.
+        # Only RGB is weighted; any alpha channel is ignored.
+        return img_linear[:, :, :3] @ _REC709_LUMA
+
+    def _scharr_gradients(self, height_map: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        shape = height_map.shape
+        smoothed = self._buf("scharr_smoothed", shape)
+        grad_x = self._buf("grad_x", shape)
+        grad_y = self._buf("grad_y", shape)
+
+        # Passes along axis 0 reach one row each way; axis-1 passes need no halo.
+        self._parallel_filter(
+            height_map,
+            lambda band: correlate1d(band, self._SCHARR_SMOOTH, axis=0, mode="reflect"),
+            halo=1,
+            out=smoothed,
+        )
+        self._parallel_filter(
+            smoothed,
+            lambda band: correlate1d(band, self._SCHARR_DIFF, axis=1, mode="reflect"),
+            halo=0,
+            out=grad_x,
+        )
+
+        self._parallel_filter(
+            height_map,
+            lambda band: correlate1d(band, self._SCHARR_SMOOTH, axis=1, mode="reflect"),
+            halo=0,
+            out=smoothed,
+        )
+        self._parallel_filter(
+            smoothed,
+            lambda band: correlate1d(band, self._SCHARR_DIFF, axis=0, mode="reflect"),
+            halo=1,
+            out=grad_y,
+        )
+        return grad_x, grad_y
+
+    def _apply_smoothing(self, height_map: np.ndarray, params: NormalMapParams) -> np.ndarray:
         if params.smoothness <= 0.0:
             return height_map
 
+        sigma = params.smoothness / params.pixel_scale
         if params.high_quality:
+            # The range sigma is in height units, so it does not depend on pixel_scale.
             sigma_color = max(1e-4, params.smoothness / 10.0)
-            sigma_spatial = max(1e-4, params.smoothness)
-            return denoise_bilateral(
+            sigma_spatial = max(1e-4, sigma)
+            if _bilateral_window is not None:
+                return self._bilateral_fast(height_map, sigma_color, sigma_spatial)
+
+            smoothed = denoise_bilateral(
                 height_map,
                 sigma_color=sigma_color,
                 sigma_spatial=sigma_spatial,
                 channel_axis=None,
             )
+            return smoothed.astype(np.float32, copy=False)
 
-        return gaussian_filter(height_map, sigma=params.smoothness)
+        if sigma < self._FFT_GAUSSIAN_SIGMA:
+            # gaussian_filter's default truncate=4.0 sets its reach.
+            return self._parallel_filter(
+                height_map,
+                lambda band: gaussian_filter(band, sigma=sigma, mode="reflect"),
+                halo=int(4.0 * sigma + 0.5),
+            )
+        return self._gaussian_fft(height_map, sigma)
+
+    def _gaussian_fft(self, height_map: np.ndarray, sigma: float) -> np.ndarray:
+        """Equivalent of gaussian_filter(mode="reflect") computed as a product of spectra."""
+        # Same support as gaussian_filter's default truncate=4.0.
+        pad = int(4.0 * sigma + 0.5)
+        # np.pad's "symmetric" is scipy.ndimage's "reflect"; the padding also absorbs the FFT wrap-around.
+        padded = np.pad(height_map, pad, mode="symmetric")
+
+        # Zero-fill up to lengths with small prime factors; the extra tail lies outside the crop.
+        shape = (fft.next_fast_len(padded.shape[0], real=True), fft.next_fast_len(padded.shape[1], real=True))
+        k_rows, k_cols = self._gaussian_kernel_fft(shape, sigma, pad)
+        spectrum = fft.rfft2(padded, s=shape, workers=self._workers)
+        spectrum *= k_rows[:, None]
+        spectrum *= k_cols[None, :]
+        smoothed = fft.irfft2(spectrum, s=shape, workers=self._workers)
+        height, width = height_map.shape
+        return smoothed[pad:pad + height, pad:pad + width].astype(np.float32, copy=False)
+
+    def _gaussian_kernel_fft(
+        self, shape: tuple[int, int], sigma: float, radius: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        key = (shape, sigma)
+        cached = self._kernel_fft_cache.get(key)
+        if cached is not None:
+            self._kernel_fft_cache.move_to_end(key)
+            return cached
+
+        offsets = np.arange(-radius, radius + 1, dtype=np.float32)
+        kernel_1d = np.exp(-0.5 * (offsets / np.float32(sigma)) ** 2)
+        kernel_1d /= kernel_1d.sum()
+
+        # The 2D kernel is separable, so its spectrum is the outer product of the 1D spectra;
+        # keep them apart and let the caller broadcast. Rolling the taps puts the kernel centre at index 0 (zero phase).
+        rows = np.zeros(shape[0], dtype=np.float32)
+        rows[: kernel_1d.size] = kernel_1d
+        cols = np.zeros(shape[1], dtype=np.float32)
+        cols[: kernel_1d.size] = kernel_1d
+        kernel_fft = (fft.fft(np.roll(rows, -radius)), fft.rfft(np.roll(cols, -radius)))
+
+        self._kernel_fft_cache[key] = kernel_fft
+        if len(self._kernel_fft_cache) > self._KERNEL_FFT_CACHE_SIZE:
+            self._kernel_fft_cache.popitem(last=False)
+        return kernel_fft
+
+    @classmethod
+    def _bilateral_fast(cls, height_map: np.ndarray, sigma_color: float, sigma_spatial: float) -> np.ndarray:
+        height_map = np.ascontiguousarray(height_map, dtype=np.float32)
+
+        # Range kernel sampled on |difference| quantized to the [0, 1] height range.
+        diffs = np.linspace(0.0, 1.0, cls._BILATERAL_COLOR_BINS, dtype=np.float32)
+        color_lut = np.exp(-0.5 * (diffs / np.float32(sigma_color)) ** 2).astype(np.float32)
+
+        if sigma_spatial <= cls._RECURSIVE_BILATERAL_SIGMA:
+            return cls._bilateral_windowed(height_map, color_lut, sigma_spatial)
+
+        alpha = np.float32(np.exp(-np.sqrt(2.0) / sigma_spatial))
+        smoothed = _bilateral_recursive(height_map, alpha, color_lut)
+        low, high = cls._RECURSIVE_BILATERAL_SIGMA, cls._RECURSIVE_BILATERAL_BLEND_END
+        if sigma_spatial < high:
+            weight = np.float32((high - sigma_spatial) / (high - low))
+            windowed = cls._bilateral_windowed(height_map, color_lut, low)
+            smoothed += weight * (windowed - smoothed)
+        return smoothed
+
+    @staticmethod
+    def _bilateral_windowed(height_map: np.ndarray, color_lut: np.ndarray, sigma_spatial: float) -> np.ndarray:
+        # Same window as skimage's denoise_bilateral default.
+        radius = max(2, int(np.ceil(3.0 * sigma_spatial)))
+        offsets = np.arange(-radius, radius + 1, dtype=np.float32)
+        spatial_lut = np.exp(-0.5 * (offsets / np.float32(sigma_spatial)) ** 2).astype(np.float32)
+        return _bilateral_window(height_map, spatial_lut, color_lut)
 
     @staticmethod
+    def _axis_scales(intensity: float, invert_x: bool, invert_y: bool) -> tuple[np.float32, np.float32]:
+        # X points against the slope. Y follows the image rows, which run downward, so
+        # green rises where the height increases down the image (the OpenGL-style Y
+        # this tool has always produced). Inverting an axis just flips the sign.
+        return (
+            np.float32(intensity if invert_x else -intensity),
+            np.float32(-intensity if invert_y else intensity),
+        )
+
     def _encode_normal_map(
+        self,
         grad_x: np.ndarray,
         grad_y: np.ndarray,
-        intensity: float,
-        invert_x: bool,
-        invert_y: bool,
+        scale_x: np.float32,
+        scale_y: np.float32,
     ) -> np.ndarray:
-        nx = -grad_x * intensity
-        ny = -grad_y * intensity
+        shape = grad_x.shape
+        nx = np.multiply(grad_x, scale_x, out=self._buf("nx", shape))
+        ny = np.multiply(grad_y, scale_y, out=self._buf("ny", shape))
 
-        if invert_x:
-            nx = -nx
-        if invert_y:
-            ny = -ny
+        # The unnormalized nz is the constant 1, so it never needs an array: it adds 1 to
+        # |n|^2 and its normalized value is inv_m itself. |n|^2 >= 1 also means the
+        # reciprocal needs no zero guard.
+        inv_m = np.square(nx, out=self._buf("inv_magnitude", shape))
+        inv_m += np.square(ny, out=self._buf("square", shape))
+        inv_m += np.float32(1.0)
+        np.sqrt(inv_m, out=inv_m)
+        np.reciprocal(inv_m, out=inv_m)
 
-        nz = np.ones_like(nx, dtype=np.float32)
+        nx *= inv_m
+        ny *= inv_m
+        nz = inv_m
 
-        magnitude = np.sqrt(nx * nx + ny * ny + nz * nz, dtype=np.float32)
-        magnitude = np.maximum(magnitude, 1e-8)
+        # Each component is finished as its own contiguous plane; the interleaved RGB
+        # layout only appears at the final byte pack.
+        normal_map = np.empty(shape + (3,), dtype=np.uint8)
+        for channel, plane in enumerate((nx, ny, nz)):
+            self._to_u8(plane, out=normal_map[:, :, channel])
+        return normal_map
 
-        nx_norm = nx / magnitude
-        ny_norm = ny / magnitude
-        nz_norm = nz / magnitude
+    @staticmethod
+    def _to_u8(plane: np.ndarray, out: np.ndarray) -> np.ndarray:
+        """Map a unit-vector component from [-1, 1] to [0, 255] and store it rounded into ``out``.
 
-        normal_map = np.stack((nx_norm, ny_norm, nz_norm), axis=-1)
-        normal_map = np.clip(normal_map * 0.5 + 0.5, 0.0, 1.0)
-        return np.rint(normal_map * 255.0).astype(np.uint8)
+        ``plane`` is used as scratch and is overwritten.
+        """
+        # (v * 0.5 + 0.5) * 255 folded into a single affine step.
+        plane *= np.float32(127.5)
+        plane += np.float32(127.5)
+        np.clip(plane, 0.0, 255.0, out=plane)
+        # Round, convert and store in one pass; the clip keeps the cast in range.
+        return np.rint(plane, out=out, casting="unsafe")
@@ -1,8 +1,15 @@
+import os
+import struct
+import tempfile
 import unittest
+import zlib
 
 import numpy as np
+from scipy import fft
+from scipy.ndimage import correlate, gaussian_filter
 
-from normalizer_logic import NormalizerLogic
+import normalizer_logic
+from normalizer_logic import NormalMapParams, NormalizerLogic, save_png16
 
 
 class TestNormalizerLogic(unittest.TestCase):
@@ -33,6 +40,182 @@ class TestNormalizerLogic(unittest.TestCase):
         self.assertTrue(np.mean(regular[..., 0]) < 128)
         self.assertTrue(np.mean(inverted[..., 0]) > 128)
 
+    def test_y_inversion_flips_green_channel_direction(self):
+        ramp = np.tile(np.linspace(0, 255, 32, dtype=np.uint8)[:, None], (1, 32))
+        image = np.stack([ramp, ramp, ramp], axis=-1)
+
+        regular = self.logic.generate_normal_map(
+            image,
+            {"intensity": 2.0, "invert_x": False, "invert_y": False, "smoothness": 0.0},
+        )
+        inverted = self.logic.generate_normal_map(
+            image,
+            {"intensity": 2.0, "invert_x": False, "invert_y": True, "smoothness": 0.0},
+        )
+
+        self.assertTrue(np.mean(regular[..., 1]) > 128)
+        self.assertTrue(np.mean(inverted[..., 1]) < 128)
+
+    def test_separable_scharr_matches_full_kernel(self):
+        rng = np.random.default_rng(0)
+        height_map = rng.random((24, 40), dtype=np.float32)
+        scharr_x = np.array([[-3, 0, 3], [-10, 0, 10], [-3, 0, 3]], dtype=np.float32) / 32.0
+
+        grad_x, grad_y = self.logic._scharr_gradients(height_map)
+
+        np.testing.assert_allclose(grad_x, correlate(height_map, scharr_x, mode="reflect"), atol=1e-6)
+        np.testing.assert_allclose(grad_y, correlate(height_map, scharr_x.T, mode="reflect"), atol=1e-6)
+
+    def test_pipeline_stays_in_float32(self):
+        image = np.random.default_rng(1).integers(0, 256, (16, 16, 3), dtype=np.uint8)
+        height_map = self.logic._to_height_map(image, linearize=True)
+        self.assertEqual(height_map.dtype, np.float32)
+
+        for high_quality in (False, True):
+            params = NormalMapParams(high_quality=high_quality, smoothness=1.5)
+            self.assertEqual(self.logic._apply_smoothing(height_map, params).dtype, np.float32)
+
+    def test_fft_gaussian_matches_gaussian_filter(self):
+        height_map = np.random.default_rng(5).random((40, 56), dtype=np.float32)
+
+        for sigma in (3.0, 6.5):
+            smoothed = self.logic._apply_smoothing(height_map, NormalMapParams(smoothness=sigma))
+            np.testing.assert_allclose(smoothed, gaussian_filter(height_map, sigma, mode="reflect"), atol=1e-5)
+
+    def test_fft_gaussian_handles_odd_sizes(self):
+        # With sigma 4.4 the padded map is 83 x 97, both prime; the transform is rounded up.
+        height_map = np.random.default_rng(6).random((47, 61), dtype=np.float32)
+
+        smoothed = self.logic._gaussian_fft(height_map, 4.4)
+
+        self.assertEqual(smoothed.shape, height_map.shape)
+        np.testing.assert_allclose(smoothed, gaussian_filter(height_map, 4.4, mode="reflect"), atol=1e-5)
+        (shape, _), = self.logic._kernel_fft_cache
+        self.assertEqual(shape, (fft.next_fast_len(83, real=True), fft.next_fast_len(97, real=True)))
+
+    def test_banded_filters_match_single_pass(self):
+        height_map = np.random.default_rng(6).random((600, 48), dtype=np.float32)
+        banded = NormalizerLogic()
+        banded._workers = 4
+
+        for serial_out, banded_out in zip(
+            self.logic._scharr_gradients(height_map), banded._scharr_gradients(height_map)
+        ):
+            np.testing.assert_array_equal(serial_out, banded_out)
+
+        params = NormalMapParams(smoothness=2.0)
+        np.testing.assert_array_equal(
+            self.logic._apply_smoothing(height_map, params), banded._apply_smoothing(height_map, params)
+        )
+
+    def test_uint8_height_map_matches_float_reference(self):
+        image = np.random.default_rng(4).integers(0, 256, (16, 16, 3), dtype=np.uint8)
+
+        for linearize, tolerance in ((True, 1e-6), (False, 1.0 / 255.0)):
+            fast = self.logic._to_height_map(image, linearize=linearize)
+            reference = self.logic._to_height_map(image.astype(np.float32), linearize=linearize)
+            np.testing.assert_allclose(fast, reference, atol=tolerance)
+
+    def test_extreme_slopes_saturate_instead_of_wrapping(self):
+        height_map = np.zeros((6, 8), dtype=np.float32)
+        height_map[:, 4:] = 1.0
+        grad_x, grad_y = self.logic._scharr_gradients(height_map)
+        expected_red = np.where(grad_x > 0, 0, 128)
+
+        encoded = self.logic._encode_normal_map(grad_x, grad_y, *self.logic._axis_scales(1e6, False, False))
+        np.testing.assert_array_equal(encoded[..., 0], expected_red)
+
+        if normalizer_logic.numba is not None:
+            fused = self.logic._scharr_encode_fused(height_map, NormalMapParams(intensity=1e6))
+            np.testing.assert_array_equal(fused[..., 0], expected_red)
+
+    def test_float_rgba_height_map_ignores_alpha(self):
+        rgba = np.random.default_rng(10).random((8, 8, 4), dtype=np.float32) * 255.0
+
+        height_map = self.logic._to_height_map(rgba, linearize=False)
+
+        self.assertEqual(height_map.shape, (8, 8))
+        np.testing.assert_allclose(height_map, self.logic._to_height_map(rgba[:, :, :3].copy(), linearize=False), atol=1e-6)
+
+    @unittest.skipIf(normalizer_logic.numba is None, "numba is not installed")
+    def test_fused_scharr_kernel_matches_separate_passes(self):
+        height_map = np.random.default_rng(8).random((21, 33), dtype=np.float32)
+        params = NormalMapParams(intensity=4.0, invert_x=True, invert_y=True)
+
+        fused = self.logic._scharr_encode_fused(height_map, params)
+        grad_x, grad_y = self.logic._scharr_gradients(height_map)
+        reference = self.logic._encode_normal_map(grad_x, grad_y, *self.logic._axis_scales(4.0, True, True))
+
+        self.assertEqual(fused.dtype, np.uint8)
+        self.assertLessEqual(np.abs(fused.astype(np.int16) - reference).max(), 1)
+        self.assertIn(np.dtype(np.float32), self.logic._jit_cache)
+
+    @unittest.skipIf(normalizer_logic.numba is None, "numba is not installed")
+    def test_windowed_bilateral_matches_direct_sum(self):
+        rng = np.random.default_rng(3)
+        height_map = rng.normal(0.5, 0.05, (32, 32)).astype(np.float32)
+        sigma_color, sigma_spatial = 0.1, 1.0
+
+        smoothed = self.logic._bilateral_fast(height_map, sigma_color, sigma_spatial)
+
+        i, j = 16, 16
+        window = height_map[i - 3:i + 4, j - 3:j + 4].astype(np.float64)
+        offsets = np.arange(-3, 4)
+        spatial = np.exp(-(offsets[:, None] ** 2 + offsets[None, :] ** 2) / (2 * sigma_spatial ** 2))
+        color = np.exp(-((window - height_map[i, j]) ** 2) / (2 * sigma_color ** 2))
+        expected = np.sum(spatial * color * window) / np.sum(spatial * color)
+        self.assertAlmostEqual(float(smoothed[i, j]), expected, places=3)
+
+    @unittest.skipIf(normalizer_logic.numba is None, "numba is not installed")
+    def test_pixel_scale_only_rescales_spatial_sigma(self):
+        height_map = np.random.default_rng(9).random((24, 24), dtype=np.float32)
+        params = NormalMapParams(high_quality=True, smoothness=4.0, pixel_scale=2.0)
+
+        np.testing.assert_array_equal(
+            self.logic._apply_smoothing(height_map, params),
+            self.logic._bilateral_fast(height_map, sigma_color=0.4, sigma_spatial=2.0),
+        )
+
+    @unittest.skipIf(normalizer_logic.numba is None, "numba is not installed")
+    def test_recursive_bilateral_preserves_edges(self):
+        step = np.zeros((48, 48), dtype=np.float32)
+        step[:, 24:] = 1.0
+
+        smoothed = self.logic._bilateral_fast(step, sigma_color=0.1, sigma_spatial=8.0)
+
+        self.assertEqual(smoothed.dtype, np.float32)
+        np.testing.assert_allclose(smoothed, step, atol=1e-3)
+
+    @unittest.skipIf(normalizer_logic.numba is None, "numba is not installed")
+    def test_bilateral_is_continuous_across_recursive_switch(self):
+        height_map = np.random.default_rng(5).random((48, 48), dtype=np.float32)
+        sigma = NormalizerLogic._RECURSIVE_BILATERAL_SIGMA
+
+        below = self.logic._bilateral_fast(height_map, sigma_color=0.1, sigma_spatial=sigma)
+        above = self.logic._bilateral_fast(height_map, sigma_color=0.1, sigma_spatial=sigma + 1e-4)
+
+        np.testing.assert_allclose(above, below, atol=1e-3)
+
+
+class TestSavePng16(unittest.TestCase):
+    def test_writes_16_bit_rgb_scaled_by_257(self):
+        image = np.random.default_rng(7).integers(0, 256, (5, 7, 3), dtype=np.uint8)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "normal.png")
+            save_png16(path, image)
+            with open(path, "rb") as fh:
+                data = fh.read()
+
+        self.assertEqual(data[:8], b"\x89PNG\r\n\x1a\n")
+        self.assertEqual(struct.unpack(">IIBB", data[16:26]), (7, 5, 16, 2))
+
+        idat_length = int.from_bytes(data[33:37], "big")
+        raw = np.frombuffer(zlib.decompress(data[41:41 + idat_length]), dtype=np.uint8).reshape(5, -1)
+        self.assertTrue(np.all(raw[:, 0] == 0))
+        samples = raw[:, 1:].copy().view(">u2").reshape(5, 7, 3)
+        np.testing.assert_array_equal(samples, image.astype(np.uint16) * 257)
+
 
 if __name__ == "__main__":
     unittest.main()